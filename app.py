@@ -1,18 +1,184 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import re
+import threading
+import time
 import gradio as gr
-import PyPDF2
-import docx
 import requests
 import json
-from typing import Optional, Dict, List
-from zhipuai import ZhipuAI  # 新增导入
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Hashable, Optional, Dict, List
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+logger = logging.getLogger(__name__)
+
+# 文档解析库、智谱SDK等较重的依赖在首次使用时才导入，缩短服务冷启动时间
+if TYPE_CHECKING:
+    from zhipuai import ZhipuAI
 
 # 智谱开放平台API配置
 ZHIPU_API_KEY = "YOUR-API-KEY"  # 更新API密钥
 ZHIPU_MODEL = "glm-4-flash-250414"  # 更新模型名称
+ZHIPU_MAX_CONCURRENCY = 5  # 同时在途的模型请求上限，避免触发平台RPM限制
+ZHIPU_POOL_SIZE = ZHIPU_MAX_CONCURRENCY  # 与智谱接口保持的HTTP连接数上限，与请求并发上限一致
+ZHIPU_MAX_ATTEMPTS = 4  # 限流、超时、服务端错误时的最大尝试次数（含首次请求）
+
+_API_SEMAPHORE = asyncio.Semaphore(ZHIPU_MAX_CONCURRENCY)
+RESULT_CACHE_SIZE = 256  # 模型结果缓存的最大条目数
+DOCUMENT_CACHE_SIZE = 32  # 文档解析结果缓存的最大条目数
+PROMPT_TOKEN_BUDGET = 3000  # 各工具输入文档的token预算
+TRANSLATE_TOKEN_BUDGET = 2000  # 翻译工具输入文档的token预算
+TOKENIZER_ENCODING = "cl100k_base"  # 智谱未提供本地分词器，使用近似的BPE编码估算token数
+ENCODING_RETRY_SECONDS = 300  # 分词器加载失败后，间隔该时长再重试
+SUMMARY_CHUNK_CHARS = 3000  # 长文档分段摘要时每段的最大字符数
+SUMMARY_CHUNK_OVERLAP = 200  # 相邻分段重叠的字符数，保留跨段上下文
+SUMMARY_MAX_CHUNKS = 16  # 分段摘要的最大段数，超出部分不参与摘要，避免超长文档耗尽调用配额
+# TXT最多读取的字符数，与分段摘要能覆盖的长度一致，超出部分任何工具都不会用到
+MAX_TXT_CHARS = SUMMARY_MAX_CHUNKS * SUMMARY_CHUNK_CHARS
+QUEUE_CONCURRENCY = 10  # 界面事件默认的并发处理数
+QUEUE_MAX_SIZE = 64  # 排队等待的请求上限，超出后新请求直接被拒绝
+LOAD_CONCURRENCY = 2  # 同时解析文档的数量上限（PDF解析占用CPU）
+_CLIENT: Optional["ZhipuAI"] = None  # 全局复用的SDK客户端（复用HTTP连接池）
+_CLIENT_LOCK = threading.Lock()  # 保证多个工作线程并发首次调用时只创建一个客户端
+_PDFIUM_LOCK = threading.Lock()  # PDFium不是线程安全的，同一时间只允许一个线程调用
+_API_ERROR_PREFIX = "API调用失败"  # 模型调用失败时返回信息的前缀
+
+
+class _LRUCache:
+    """基于OrderedDict的LRU缓存，超出容量时淘汰最久未使用的条目
+    缓存同时被Gradio工作线程和事件循环访问，读写均加锁
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+@dataclass(frozen=True)
+class DocumentState:
+    """文档预处理结果：各工具需要的派生数据在加载时计算一次，调用工具时直接读取"""
+    text: str  # 完整文档文本
+    length: int  # 文本字符数，用于各工具的长度校验
+    prompt_slice: str  # 按PROMPT_TOKEN_BUDGET截断后的文本，用于提示词
+    translate_slice: str  # 按TRANSLATE_TOKEN_BUDGET截断后的文本，用于翻译
+
+
+# 以(提示词摘要, max_tokens)为键缓存模型结果；提示词已包含文档片段和各工具参数
+_RESULT_CACHE = _LRUCache(RESULT_CACHE_SIZE)
+# 以(解析函数名, 文件内容SHA-256)为键缓存解析出的文本，重复上传同一文件时跳过解析
+_DOCUMENT_CACHE = _LRUCache(DOCUMENT_CACHE_SIZE)
+# 以文档文本摘要为键缓存DocumentState，同一文档只预处理一次，供所有工具复用
+_STATE_CACHE = _LRUCache(DOCUMENT_CACHE_SIZE)
+# 分词器在后台线程中加载（首次需要下载词表）；加载成功前为None，此时按字符截断
+_ENCODING: Any = None
+_ENCODING_LOCK = threading.Lock()
+_ENCODING_LAST_ATTEMPT = float("-inf")
+
+# 提示词模板：集中定义在模块级，调用时用format_map填充文档片段和参数
+_SUMMARY_TMPL = "请总结以下文档的核心内容，要求简洁明了，不超过300字：\n{text}"
+_CHUNK_SUMMARY_TMPL = "以下是一篇长文档中的一部分，请总结这部分的核心内容，要求简洁明了，不超过300字：\n{text}"
+_COMBINE_SUMMARY_TMPL = "以下是一篇长文档各部分的摘要，请将它们整合为整篇文档的摘要，要求简洁明了，不超过300字：\n{text}"
+_KEY_INFO_TMPL = "请从以下文档中提取关键信息，包括主要观点、重要数据、核心结论等，用结构化的方式（如分点、表格）呈现：\n{text}"
+_QA_TMPL = (
+    "基于以下文档内容，回答问题：{question}\n"
+    "文档内容：{text}\n"
+    "要求：只能根据文档内容回答，不编造信息；若文档无相关内容，需明确说明"
+)
+_TRANSLATE_TMPL = "请将以下文本翻译成{target_lang}，保持原意准确，语言流畅：\n{text}"
+_FORMAT_TMPL = "请将以下文本转换为{target_format}格式，保持内容完整和结构清晰：\n{text}"
+_MULTI_TOOL_TMPL = (
+    "请针对以下文档完成多项任务，只输出一个JSON对象，不要输出其他内容。JSON包含以下键：\n"
+    "{requirements}\n"
+    "文档内容：{text}"
+)
+
+# multi_tool支持的任务：任务名 -> (JSON键, 任务要求, 该任务的输出长度预算)
+_MULTI_TOOL_TASKS = {
+    "摘要": ("summary", "文档核心内容的摘要，简洁明了，不超过300字", 300),
+    "关键信息": ("key_info", "文档的关键信息，包括主要观点、重要数据、核心结论等，分点呈现", 500),
+    "翻译": ("translation", "将文档翻译成{target_lang}，保持原意准确，语言流畅", 2000),
+}
 
 # ------------------------------
 # MCP协议工具函数（核心，需严格遵循规范）
 # ------------------------------
+def _read_pdf_pdfium(file_path: str) -> str:
+    """使用PDFium提取PDF文本，逐页提取后立即释放页面资源"""
+    import pypdfium2 as pdfium  # 基于PDFium(C++)的PDF文本提取，速度远快于PyPDF2
+    
+    # 文档加载事件允许多个线程同时执行，PDFium调用需串行化
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            texts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            return "\n".join(texts)
+        finally:
+            pdf.close()
+
+
+def _extract_pdf(file_path: str) -> str:
+    """提取PDF文本，优先使用PDFium，失败时回退到PyPDF2；读取失败时抛出异常"""
+    try:
+        return _read_pdf_pdfium(file_path)
+    except Exception:
+        pass  # 未安装pypdfium2或PDFium无法处理时回退到PyPDF2
+    
+    import PyPDF2
+    
+    with open(file_path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        return "".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _extract_word(file_path: str) -> str:
+    """提取Word文本，读取失败时抛出异常"""
+    import docx
+    
+    doc = docx.Document(file_path)
+    return "\n".join(para.text for para in doc.paragraphs)
+
+
+def _extract_txt(file_path: str) -> str:
+    """提取TXT文本（最多MAX_TXT_CHARS个字符），读取失败时抛出异常"""
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read(MAX_TXT_CHARS)
+
+
 def read_pdf(file_path: str) -> str:
     """读取PDF文件内容（MCP工具）
     Args:
@@ -21,12 +187,7 @@ def read_pdf(file_path: str) -> str:
         str: 提取的PDF文本内容，若读取失败返回错误信息
     """
     try:
-        with open(file_path, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        return text
+        return _extract_pdf(file_path)
     except Exception as e:
         return f"PDF读取失败: {str(e)}"
 
@@ -39,8 +200,7 @@ def read_word(file_path: str) -> str:
         str: 提取的Word文本内容，若读取失败返回错误信息
     """
     try:
-        doc = docx.Document(file_path)
-        return "\n".join([para.text for para in doc.paragraphs])
+        return _extract_word(file_path)
     except Exception as e:
         return f"Word读取失败: {str(e)}"
 
@@ -50,15 +210,31 @@ def read_txt(file_path: str) -> str:
     Args:
         file_path: TXT文件的本地路径或临时路径
     Returns:
-        str: 提取的TXT文本内容，若读取失败返回错误信息
+        str: 提取的TXT文本内容（最多MAX_TXT_CHARS个字符），若读取失败返回错误信息
     """
     try:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
+        return _extract_txt(file_path)
     except Exception as e:
         return f"TXT读取失败: {str(e)}"
 
 
+def _file_sha256(file_path: str) -> str:
+    """分块计算文件内容的SHA-256摘要"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 文件扩展名（小写）-> (提取函数, 错误信息中的文件类型名)
+_READERS = {
+    ".pdf": (_extract_pdf, "PDF"),
+    ".docx": (_extract_word, "Word"),
+    ".txt": (_extract_txt, "TXT"),
+}
+
+
 def parse_document(file_path: str) -> str:
     """根据文件类型解析文档内容（MCP核心工具）
     Args:
@@ -69,17 +245,165 @@ def parse_document(file_path: str) -> str:
     if not file_path:
         return "文件路径为空"
     
-    if file_path.endswith(".pdf"):
-        return read_pdf(file_path)
-    elif file_path.endswith(".docx"):
-        return read_word(file_path)
-    elif file_path.endswith(".txt"):
-        return read_txt(file_path)
-    else:
+    reader = _READERS.get(os.path.splitext(file_path)[1].lower())
+    if reader is None:
         return "不支持的文件格式，仅支持PDF(.pdf)、Word(.docx)、TXT(.txt)"
+    extract, kind = reader
+    
+    try:
+        cache_key = (extract.__name__, _file_sha256(file_path))
+    except OSError as e:
+        return f"文件读取失败: {str(e)}"
+    
+    text = _DOCUMENT_CACHE.get(cache_key)
+    if text is None:
+        try:
+            text = extract(file_path)
+        except Exception as e:
+            # 失败信息不写入缓存，下次加载（如安装依赖后）会重新解析
+            return f"{kind}读取失败: {str(e)}"
+        _DOCUMENT_CACHE.put(cache_key, text)
+    return text
+
+
+def _load_encoding() -> None:
+    """加载分词器；首次使用需下载词表，可能很慢甚至一直无响应，因此只在后台线程中调用"""
+    global _ENCODING
+    try:
+        import tiktoken  # 按token而非字符截断输入文本
+        
+        _ENCODING = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning("分词器加载失败，暂按字符截断，%d秒后重试: %s", ENCODING_RETRY_SECONDS, e)
+
 
+def _start_encoding_load() -> None:
+    """在后台线程中加载分词器；已加载或距上次尝试不足ENCODING_RETRY_SECONDS时不重复发起
+    不等待上次尝试结束：下载一直无响应时，超过重试间隔后也会重新发起加载
+    """
+    global _ENCODING_LAST_ATTEMPT
+    with _ENCODING_LOCK:
+        now = time.monotonic()
+        if _ENCODING is not None or now - _ENCODING_LAST_ATTEMPT < ENCODING_RETRY_SECONDS:
+            return
+        _ENCODING_LAST_ATTEMPT = now
+    threading.Thread(target=_load_encoding, name="encoding-loader", daemon=True).start()
+
+
+def _get_encoding():
+    """获取分词器；尚未加载成功时在后台发起加载并返回None，调用方不会被下载阻塞"""
+    if _ENCODING is None:
+        _start_encoding_load()
+    return _ENCODING
+
+
+def _trim_to_tokens(text: str, encoding: Any, *budgets: int) -> List[str]:
+    """按各个token预算截断文本（只分词一次），避免按字符截断时浪费预算或超出预算
+    没有可用分词器（encoding为None）时退化为按字符截断
+    """
+    if encoding is None:
+        return [text[:budget] for budget in budgets]
+    
+    # 单个token不会超过约8个字符，只需对开头足够长的部分分词
+    head = text[:max(budgets) * 8]
+    tokens = encoding.encode(head, disallowed_special=())
+    slices = []
+    for budget in budgets:
+        if len(tokens) <= budget and len(head) == len(text):
+            slices.append(text)
+        else:
+            # 截断处可能切开多token字符，去掉解码出的替换字符
+            slices.append(encoding.decode(tokens[:budget]).rstrip("\ufffd"))
+    return slices
 
-def call_model_api(prompt: str, max_tokens: int = 1024) -> str:
+
+def _document_state(text: str) -> DocumentState:
+    """获取文档的预处理状态，同一文档只计算一次，之后各工具直接复用
+    包含分词和哈希计算，在异步工具中应通过asyncio.to_thread调用，避免阻塞事件循环
+    """
+    sha = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    encoding = _get_encoding()
+    # 缓存键区分是否按token截断，分词器加载成功后不再沿用按字符截断的结果
+    cache_key = (sha, encoding is not None)
+    state = _STATE_CACHE.get(cache_key)
+    if state is None:
+        prompt_slice, translate_slice = _trim_to_tokens(
+            text, encoding, PROMPT_TOKEN_BUDGET, TRANSLATE_TOKEN_BUDGET
+        )
+        state = DocumentState(
+            text=text,
+            length=len(text),
+            prompt_slice=prompt_slice,
+            translate_slice=translate_slice
+        )
+        _STATE_CACHE.put(cache_key, state)
+    return state
+
+
+def _get_client() -> "ZhipuAI":
+    """获取全局智谱SDK客户端，首次调用时创建，之后复用"""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:  # 加锁后再次检查，其他线程可能已完成创建
+                import httpx
+                from zhipuai import ZhipuAI
+                
+                # 显式配置连接池；安装了h2时启用HTTP/2，并发请求复用同一连接（多路复用）
+                http_client = httpx.Client(
+                    http2=importlib.util.find_spec("h2") is not None,
+                    limits=httpx.Limits(
+                        max_connections=ZHIPU_POOL_SIZE,
+                        max_keepalive_connections=ZHIPU_POOL_SIZE
+                    )
+                )
+                # 重试统一由tenacity负责，关闭SDK内置重试，避免两层重试叠加
+                _CLIENT = ZhipuAI(api_key=ZHIPU_API_KEY, max_retries=0, http_client=http_client)
+    return _CLIENT
+
+
+def _result_cache_key(prompt: str, max_tokens: int) -> tuple:
+    """计算模型结果缓存键（对提示词取blake2b摘要，避免以长文本作为字典键）"""
+    digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+    return digest, max_tokens
+
+
+def _is_transient_error(error: BaseException) -> bool:
+    """判断是否为可重试的临时错误：限流(429)、超时/连接错误、服务端错误(500/503)"""
+    from zhipuai import (
+        APIConnectionError,
+        APIInternalError,
+        APIReachLimitError,
+        APIServerFlowExceedError,
+    )
+    
+    return isinstance(
+        error, (APIReachLimitError, APIConnectionError, APIInternalError, APIServerFlowExceedError)
+    )
+
+
+@retry(
+    stop=stop_after_attempt(ZHIPU_MAX_ATTEMPTS),
+    wait=wait_random_exponential(min=1, max=20),
+    retry=retry_if_exception(_is_transient_error),
+    before_sleep=before_sleep_log(logger, logging.WARNING),  # 每次重试前记录失败原因
+    reraise=True
+)
+def _create_completion(prompt: str, max_tokens: int, stream: bool = False):
+    """同步调用智谱SDK（在线程池中执行，避免阻塞事件循环）
+    stream=True时返回增量片段的迭代器，否则返回完整响应；
+    遇到限流(429)、超时/连接错误、服务端错误(500/503)时按带抖动的指数退避重试
+    """
+    return _get_client().chat.completions.create(
+        model=ZHIPU_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=0.7,
+        stream=stream
+    )
+
+
+async def call_model_api(prompt: str, max_tokens: int = 1024) -> str:
     """调用智谱模型API生成文本（MCP工具）
     Args:
         prompt: 模型输入提示词
@@ -87,118 +411,308 @@ def call_model_api(prompt: str, max_tokens: int = 1024) -> str:
     Returns:
         str: 模型生成的文本；若调用失败，返回错误信息
     """
-    if not ZHIPU_API_KEY:
-        return "请配置智谱开放平台API密钥（ZHIPU_API_KEY）"
+    cache_key = _result_cache_key(prompt, max_tokens)
+    cached = _RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
     
     try:
-        client = ZhipuAI(api_key=ZHIPU_API_KEY)
-        response = client.chat.completions.create(
-            model=ZHIPU_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=max_tokens,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
+        async with _API_SEMAPHORE:
+            response = await asyncio.to_thread(_create_completion, prompt, max_tokens)
+        text = response.choices[0].message.content
     except Exception as e:
-        return f"API调用失败: {str(e)}"
+        logger.warning("模型API调用失败: %s: %s", type(e).__name__, e)
+        return f"{_API_ERROR_PREFIX}: {str(e)}"
+    _RESULT_CACHE.put(cache_key, text)
+    return text
 
 
-def generate_summary(text: str) -> str:
-    """生成文档摘要（MCP工具）
+async def call_model_api_stream(prompt: str, max_tokens: int = 1024) -> AsyncIterator[str]:
+    """流式调用智谱模型API生成文本（MCP工具）
+    Args:
+        prompt: 模型输入提示词
+        max_tokens: 生成文本的最大长度，默认1024
+    Returns:
+        str: 逐步累积的模型生成文本（每收到一个新片段输出一次）；若调用失败，输出错误信息
+    """
+    cache_key = _result_cache_key(prompt, max_tokens)
+    cached = _RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+    
+    try:
+        async with _API_SEMAPHORE:
+            chunks = await asyncio.to_thread(_create_completion, prompt, max_tokens, True)
+            parts = []
+            try:
+                # 逐个拉取增量片段，读取网络的阻塞操作放在线程中执行
+                while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:  # 没有新内容的片段（如结束片段）不重复输出
+                        parts.append(delta)
+                        yield "".join(parts)
+            finally:
+                # 出错或调用方中途取消时关闭响应，把连接归还给连接池
+                chunks.response.close()
+    except Exception as e:
+        logger.warning("模型API调用失败: %s: %s", type(e).__name__, e)
+        yield f"{_API_ERROR_PREFIX}: {str(e)}"
+        return
+    text = "".join(parts)
+    if not parts:
+        yield text  # 模型未返回任何内容时也输出一次空结果
+    # 只缓存完整成功的结果，失败或中途取消的调用下次仍会重新请求
+    _RESULT_CACHE.put(cache_key, text)
+
+
+def chunk_text(
+    text: str,
+    max_chars: int = SUMMARY_CHUNK_CHARS,
+    overlap: int = SUMMARY_CHUNK_OVERLAP,
+    max_chunks: Optional[int] = None
+) -> List[str]:
+    """按段落边界将长文本切分为多个片段
     Args:
-        text: 待摘要的文档文本（建议长度50-3000字）
+        text: 待切分的文本
+        max_chars: 每个片段的最大字符数，默认SUMMARY_CHUNK_CHARS
+        overlap: 相邻片段重叠的字符数，用于保留跨片段的上下文，默认SUMMARY_CHUNK_OVERLAP，须小于max_chars
+        max_chunks: 最多切分出的片段数，达到后不再处理剩余文本，默认不限制
     Returns:
-        str: 文档摘要（≤300字）；若文本过短，返回提示信息
+        List[str]: 切分后的文本片段列表，每个片段不超过max_chars个字符
     """
-    if len(text) < 50:
-        return "文档内容过短（少于50字），无法生成摘要"
+    if not 0 <= overlap < max_chars:
+        raise ValueError(f"overlap须满足0 <= overlap < max_chars，当前overlap={overlap}，max_chars={max_chars}")
+    if max_chunks is not None and max_chunks < 1:
+        raise ValueError(f"max_chunks须大于0，当前max_chunks={max_chunks}")
     
-    prompt = f"""请总结以下文档的核心内容，要求简洁明了，不超过300字：
-    {text[:3000]}  # 限制输入长度，避免超出模型上下文
+    chunks = []
+    current = ""
+    for para in re.split(r"\n\s*\n", text):
+        if not para.strip():
+            continue
+        sep = "\n\n" if current else ""
+        # 当前片段放不下该段落时另起片段；超长段落无论如何都要切分，
+        # 只要当前片段还有空间就直接接在后面，避免产生过短的片段
+        if current and len(current) + len(sep) + len(para) > max_chars and (
+                len(para) <= max_chars or len(current) + len(sep) >= max_chars):
+            chunks.append(current)
+            if len(chunks) == max_chunks:
+                return chunks
+            current = current[-overlap:] if overlap else ""
+            sep = "\n\n" if current else ""
+        if len(current) + len(sep) >= max_chars:
+            current, sep = "", ""  # 仅剩的重叠部分加分隔符已占满片段时放弃重叠
+        current += sep
+        # 放不下的超长段落按长度硬切分，同一段落的各部分直接相连，不插入段落分隔符；
+        # 用下标记录已切出的位置，避免每次切分都复制段落剩余部分
+        start = 0
+        while len(current) + len(para) - start > max_chars:
+            end = start + max_chars - len(current)
+            current += para[start:end]
+            start = end
+            chunks.append(current)
+            if len(chunks) == max_chunks:
+                return chunks
+            current = current[-overlap:] if overlap else ""
+        current += para[start:]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def generate_summary(text: str) -> AsyncIterator[str]:
+    """生成文档摘要（MCP工具）
+    Args:
+        text: 待摘要的文档文本（建议长度≥50字；超出输入长度上限的长文档会分段摘要后再汇总）
+    Returns:
+        str: 文档摘要（≤300字，流式逐步输出）；若文本过短，返回提示信息
     """
-    return call_model_api(prompt, max_tokens=300)
+    doc = await asyncio.to_thread(_document_state, text)
+    if doc.length < 50:
+        yield "文档内容过短（少于50字），无法生成摘要"
+        return
+    
+    if doc.prompt_slice == doc.text:
+        prompt = _SUMMARY_TMPL.format_map({"text": doc.prompt_slice})
+        async for partial in call_model_api_stream(prompt, max_tokens=300):
+            yield partial
+        return
+    
+    # 长文档：各段并行摘要（并发受_API_SEMAPHORE限制），再汇总为整篇摘要。
+    # 多切一段用于判断是否超出上限，超出部分不再切分；切分较耗时，放在线程中执行
+    chunks = await asyncio.to_thread(chunk_text, doc.text, max_chunks=SUMMARY_MAX_CHUNKS + 1)
+    truncated = len(chunks) > SUMMARY_MAX_CHUNKS
+    chunks = chunks[:SUMMARY_MAX_CHUNKS]
+    note = ""
+    if truncated:
+        note = f"\n\n（注：文档过长，只摘要了前{len(chunks)}段，其余内容未纳入摘要）"
+        yield f"文档过长，正在对前{len(chunks)}段生成摘要（其余内容超出上限，不纳入摘要）……"
+    else:
+        yield f"文档较长，正在分{len(chunks)}段生成摘要……"
+    partials = await asyncio.gather(*(
+        call_model_api(_CHUNK_SUMMARY_TMPL.format_map({"text": chunk}), max_tokens=300)
+        for chunk in chunks
+    ))
+    for partial in partials:
+        if partial.startswith(_API_ERROR_PREFIX):
+            yield partial
+            return
+    
+    combined = "\n\n".join(f"第{i}部分：{partial}" for i, partial in enumerate(partials, 1))
+    prompt = _COMBINE_SUMMARY_TMPL.format_map({"text": combined})
+    async for partial in call_model_api_stream(prompt, max_tokens=300):
+        yield partial + note
 
 
-def extract_key_info(text: str) -> str:
+async def extract_key_info(text: str) -> AsyncIterator[str]:
     """提取文档关键信息（MCP工具）
     Args:
         text: 待提取信息的文档文本（建议长度50-3000字）
     Returns:
-        str: 结构化的关键信息（含主要观点、数据、结论）；若文本过短，返回提示信息
+        str: 结构化的关键信息（含主要观点、数据、结论，流式逐步输出）；若文本过短，返回提示信息
     """
-    if len(text) < 50:
-        return "文档内容过短（少于50字），无法提取关键信息"
+    doc = await asyncio.to_thread(_document_state, text)
+    if doc.length < 50:
+        yield "文档内容过短（少于50字），无法提取关键信息"
+        return
     
-    prompt = f"""请从以下文档中提取关键信息，包括主要观点、重要数据、核心结论等，用结构化的方式（如分点、表格）呈现：
-    {text[:3000]}
-    """
-    return call_model_api(prompt, max_tokens=500)
+    prompt = _KEY_INFO_TMPL.format_map({"text": doc.prompt_slice})
+    async for partial in call_model_api_stream(prompt, max_tokens=500):
+        yield partial
 
 
-def document_qa(text: str, question: str) -> str:
+async def document_qa(text: str, question: str) -> AsyncIterator[str]:
     """基于文档内容回答问题（MCP工具）
     Args:
         text: 文档文本（建议长度50-3000字）
         question: 待回答的问题
     Returns:
-        str: 基于文档的回答；若问题为空或文本过短，返回提示信息
+        str: 基于文档的回答（流式逐步输出）；若问题为空或文本过短，返回提示信息
     """
     if not question:
-        return "请输入问题"
-    if len(text) < 50:
-        return "文档内容过短（少于50字），无法回答问题"
+        yield "请输入问题"
+        return
+    doc = await asyncio.to_thread(_document_state, text)
+    if doc.length < 50:
+        yield "文档内容过短（少于50字），无法回答问题"
+        return
     
-    prompt = f"""基于以下文档内容，回答问题：{question}
-    文档内容：{text[:3000]}
-    要求：只能根据文档内容回答，不编造信息；若文档无相关内容，需明确说明
-    """
-    return call_model_api(prompt, max_tokens=500)
+    prompt = _QA_TMPL.format_map({"question": question, "text": doc.prompt_slice})
+    async for partial in call_model_api_stream(prompt, max_tokens=500):
+        yield partial
 
 
-def translate_text(text: str, target_lang: str) -> str:
+async def translate_text(text: str, target_lang: str) -> AsyncIterator[str]:
     """翻译文本到目标语言（MCP工具）
     Args:
         text: 待翻译的文本（建议长度10-2000字）
         target_lang: 目标语言（支持：中文、英文、日文、韩文、法文、德文）
     Returns:
-        str: 翻译后的文本；若文本过短，返回提示信息
+        str: 翻译后的文本（流式逐步输出）；若文本过短，返回提示信息
     """
-    if len(text) < 10:
-        return "文本过短（少于10字），无法翻译"
+    doc = await asyncio.to_thread(_document_state, text)
+    if doc.length < 10:
+        yield "文本过短（少于10字），无法翻译"
+        return
     supported_langs = ["中文", "英文", "日文", "韩文", "法文", "德文"]
     if target_lang not in supported_langs:
-        return f"不支持的目标语言：{target_lang}（支持：{','.join(supported_langs)}）"
+        yield f"不支持的目标语言：{target_lang}（支持：{','.join(supported_langs)}）"
+        return
     
-    prompt = f"""请将以下文本翻译成{target_lang}，保持原意准确，语言流畅：
-    {text[:2000]}
-    """
-    return call_model_api(prompt, max_tokens=2000)
+    prompt = _TRANSLATE_TMPL.format_map({"target_lang": target_lang, "text": doc.translate_slice})
+    async for partial in call_model_api_stream(prompt, max_tokens=2000):
+        yield partial
 
 
-def format_conversion(text: str, target_format: str) -> str:
+async def format_conversion(text: str, target_format: str) -> AsyncIterator[str]:
     """转换文本格式（MCP工具）
     Args:
         text: 待转换的文本（建议长度50-3000字）
         target_format: 目标格式（支持：Markdown、表格、项目符号列表、编号列表）
     Returns:
-        str: 转换后的文本；若文本过短，返回提示信息
+        str: 转换后的文本（流式逐步输出）；若文本过短，返回提示信息
     """
-    if len(text) < 50:
-        return "文本过短（少于50字），无法转换格式"
+    doc = await asyncio.to_thread(_document_state, text)
+    if doc.length < 50:
+        yield "文本过短（少于50字），无法转换格式"
+        return
     supported_formats = ["Markdown", "表格", "项目符号列表", "编号列表"]
     if target_format not in supported_formats:
-        return f"不支持的目标格式：{target_format}（支持：{','.join(supported_formats)}）"
+        yield f"不支持的目标格式：{target_format}（支持：{','.join(supported_formats)}）"
+        return
     
-    prompt = f"""请将以下文本转换为{target_format}格式，保持内容完整和结构清晰：
-    {text[:3000]}
+    prompt = _FORMAT_TMPL.format_map({"target_format": target_format, "text": doc.prompt_slice})
+    async for partial in call_model_api_stream(prompt, max_tokens=1000):
+        yield partial
+
+
+async def multi_tool(text: str, tasks: List[str], target_lang: str = "英文") -> str:
+    """在一次模型调用中完成多项文档处理任务（MCP工具）
+    Args:
+        text: 待处理的文档文本（建议长度50-3000字）
+        tasks: 需要执行的任务列表（支持：摘要、关键信息、翻译）
+        target_lang: 翻译任务的目标语言（支持：中文、英文、日文、韩文、法文、德文），默认英文
+    Returns:
+        str: 按任务分节的Markdown结果；若文本过短或参数不合法，返回提示信息
     """
-    return call_model_api(prompt, max_tokens=1000)
+    doc = await asyncio.to_thread(_document_state, text)
+    if doc.length < 50:
+        return "文档内容过短（少于50字），无法处理"
+    if not tasks:
+        return "请至少选择一项任务"
+    unsupported_tasks = [task for task in tasks if task not in _MULTI_TOOL_TASKS]
+    if unsupported_tasks:
+        return f"不支持的任务：{','.join(unsupported_tasks)}（支持：{','.join(_MULTI_TOOL_TASKS)}）"
+    supported_langs = ["中文", "英文", "日文", "韩文", "法文", "德文"]
+    if "翻译" in tasks and target_lang not in supported_langs:
+        return f"不支持的目标语言：{target_lang}（支持：{','.join(supported_langs)}）"
+    
+    # 文档内容只在提示词中出现一次，多个任务共享同一份输入；
+    # 包含翻译时使用翻译的输入预算，保证译文能放进该任务的输出预算
+    doc_slice = doc.translate_slice if "翻译" in tasks else doc.prompt_slice
+    selected = [task for task in _MULTI_TOOL_TASKS if task in tasks]
+    requirements = "\n".join(
+        f'- "{_MULTI_TOOL_TASKS[task][0]}": {_MULTI_TOOL_TASKS[task][1].format(target_lang=target_lang)}'
+        for task in selected
+    )
+    prompt = _MULTI_TOOL_TMPL.format_map({"requirements": requirements, "text": doc_slice})
+    max_tokens = sum(_MULTI_TOOL_TASKS[task][2] for task in selected)
+    result = await call_model_api(prompt, max_tokens=max_tokens)
+    
+    if result.startswith(_API_ERROR_PREFIX):
+        return result
+    
+    try:
+        # 模型常把JSON包在```json代码块中，解析前先去掉
+        data = json.loads(result.strip().removeprefix("```json").removeprefix("```").removesuffix("```"))
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        # 输出被截断或格式不对时不保留缓存，再次点击会重新请求
+        _RESULT_CACHE.pop(_result_cache_key(prompt, max_tokens))
+        return "模型输出不完整或不是合法的JSON（可能超出了输出长度上限），请重试，或减少任务数量、分别使用各项功能"
+    
+    sections = []
+    for task in selected:
+        value = data.get(_MULTI_TOOL_TASKS[task][0], "")
+        if isinstance(value, list):
+            value = "\n".join(f"- {item}" for item in value)
+        elif not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False, indent=2)
+        sections.append(f"## {task}\n\n{value}")
+    return "\n\n".join(sections)
 
 
 # ------------------------------
 # Gradio界面与MCP服务启动
 # ------------------------------
 def main():
+    # 密钥在进程启动后不会再变化，启动时校验一次，调用模型时不再重复检查
+    if not ZHIPU_API_KEY or ZHIPU_API_KEY == "YOUR-API-KEY":
+        raise RuntimeError("请配置智谱开放平台API密钥（ZHIPU_API_KEY）")
+    _start_encoding_load()  # 启动时在后台加载分词器，不阻塞服务启动和请求处理
+    
     with gr.Blocks(title="智能文档处理助手") as demo:
         gr.Markdown("# 📄 智能文档处理助手")
         gr.Markdown("基于大模型的文档处理工具，支持摘要、问答、翻译等功能（MCP兼容）")
@@ -230,55 +744,88 @@ def main():
                         value="Markdown"
                     )
                     format_btn = gr.Button("转换格式")
+                
+                with gr.Accordion("一键处理", open=True):
+                    multi_tasks = gr.CheckboxGroup(
+                        ["摘要", "关键信息", "翻译"],
+                        label="处理任务（一次调用完成，翻译使用上方目标语言）",
+                        value=["摘要", "关键信息"]
+                    )
+                    multi_btn = gr.Button("一键处理")
             
             with gr.Column(scale=2):
                 doc_content = gr.Textbox(label="文档内容", lines=10, interactive=False)
                 result_output = gr.Markdown(label="处理结果")
         
         # 事件绑定（前端交互逻辑）
+        # 所有调用模型的事件共用同一个并发组，整体并发与ZHIPU_MAX_CONCURRENCY一致
         def load_document(file):
             if not file:
                 return "请上传文档"
-            return parse_document(file.name)  # file.name为临时文件路径
+            text = parse_document(file.name)  # file.name为临时文件路径
+            _document_state(text)  # 加载时预先完成截断等预处理，后续各工具直接复用
+            return text
         
         load_btn.click(
             fn=load_document,
             inputs=[file_input],
-            outputs=[doc_content]
+            outputs=[doc_content],
+            concurrency_limit=LOAD_CONCURRENCY  # 文档解析占用CPU，限制同时解析的数量
         )
         
         summary_btn.click(
             fn=generate_summary,
             inputs=[doc_content],
-            outputs=[result_output]
+            outputs=[result_output],
+            concurrency_limit=ZHIPU_MAX_CONCURRENCY,
+            concurrency_id="model_api"
         )
         
         key_info_btn.click(
             fn=extract_key_info,
             inputs=[doc_content],
-            outputs=[result_output]
+            outputs=[result_output],
+            concurrency_limit=ZHIPU_MAX_CONCURRENCY,
+            concurrency_id="model_api"
         )
         
         qa_btn.click(
             fn=document_qa,
             inputs=[doc_content, question_input],
-            outputs=[result_output]
+            outputs=[result_output],
+            concurrency_limit=ZHIPU_MAX_CONCURRENCY,
+            concurrency_id="model_api"
         )
         
         translate_btn.click(
             fn=translate_text,
             inputs=[doc_content, target_lang],
-            outputs=[result_output]
+            outputs=[result_output],
+            concurrency_limit=ZHIPU_MAX_CONCURRENCY,
+            concurrency_id="model_api"
         )
         
         format_btn.click(
             fn=format_conversion,
             inputs=[doc_content, target_format],
-            outputs=[result_output]
+            outputs=[result_output],
+            concurrency_limit=ZHIPU_MAX_CONCURRENCY,
+            concurrency_id="model_api"
+        )
+        
+        multi_btn.click(
+            fn=multi_tool,
+            inputs=[doc_content, multi_tasks, target_lang],
+            outputs=[result_output],
+            concurrency_limit=ZHIPU_MAX_CONCURRENCY,
+            concurrency_id="model_api"
         )
     
-    # 启动服务
-    demo.launch(
+    # 启动服务（开启请求队列，多个用户的请求可并发处理而不是逐个排队）
+    demo.queue(
+        default_concurrency_limit=QUEUE_CONCURRENCY,
+        max_size=QUEUE_MAX_SIZE
+    ).launch(
         mcp_server=True,
         server_name="0.0.0.0",
         server_port=7860,